@@ -2,6 +2,11 @@
 import subprocess
 import json
 import argparse
+import os
+import re
+import select
+import sys
+import time
 
 
 class config:
@@ -28,6 +33,90 @@ class config:
     # If this is true the workspace number is suppressed
     compressed = False
 
+    # Rules used to automatically determine the tags of a workspace.
+    # The regex in "match" is searched case-insensitively in the value
+    # of the window property "property" and if it matches, "tag" is
+    # added to the workspace.
+    tag_rules = [
+        {"property": "window_role", "match": "^browser$", "tag": "web"},
+        {"property": "class", "match": "^(firefox|qutebrowser)$",
+         "tag": "web"},
+        {"property": "class", "match": "thunderbird", "tag": "mail"},
+        {"property": "class", "match": "mpv", "tag": "film"},
+    ]
+
+    # Time to wait for further events before the daemon renames
+    # the affected workspaces (in seconds)
+    debounce = 0.3
+
+    # Maximal time the daemon delays a rename, even if
+    # events keep arriving (in seconds)
+    max_latency = 2.0
+
+    # File from which the above settings may be overwritten
+    configfile = "~/.mfhBin/i3_workspace.yaml"
+
+
+def load_config(path):
+    """ Update the config from the yaml file at path (if it exists) """
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return
+
+    import yaml
+    with open(path, "r") as cfg:
+        loaded = yaml.safe_load(cfg) or {}
+
+    if not isinstance(loaded, dict):
+        raise SystemExit("Config file '" + path + "' is not a mapping.")
+
+    def is_number(value):
+        return isinstance(value, (int, float)) and \
+            not isinstance(value, bool) and value >= 0
+
+    def is_symbol_map(value):
+        return isinstance(value, dict) and \
+            all(isinstance(k, str) and isinstance(v, str)
+                for k, v in value.items())
+
+    checks = {
+        "tag_to_symbol": (is_symbol_map, "a mapping from tags to symbols"),
+        "separator": (lambda v: isinstance(v, str), "a string"),
+        "compressed": (lambda v: isinstance(v, bool), "a boolean"),
+        "tag_rules": (lambda v: isinstance(v, list), "a list of rules"),
+        "debounce": (is_number, "a non-negative number"),
+        "max_latency": (is_number, "a non-negative number"),
+    }
+    for key, (check, expected) in checks.items():
+        if key in loaded:
+            if not check(loaded[key]):
+                raise SystemExit("Invalid config value for '" + key +
+                                 "': Expected " + expected + ".")
+            setattr(config, key, loaded[key])
+
+
+def compile_tag_rules(rules):
+    """ Compile a list of tag rules (see config.tag_rules) into
+        the rule table used by window_tags """
+    table = []
+    for rule in rules:
+        keys = ["property", "match", "tag"]
+        if not isinstance(rule, dict) or \
+           not all(isinstance(rule.get(k), str) for k in keys):
+            raise SystemExit("Malformed tag rule: " + str(rule) + ". Rules "
+                             "need the string entries " + ", ".join(keys))
+        prop, pattern, tag = (rule[k] for k in keys)
+
+        if tag not in config.tag_to_symbol:
+            raise SystemExit("Unknown tag in tag rule: " + tag)
+        try:
+            regex = re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            raise SystemExit("Invalid regex '" + pattern + "' in tag rule: "
+                             + str(e))
+        table.append((prop, regex, tag))
+    return table
+
 
 # TODO Make a workspace class?
 def i3_workspaces():
@@ -57,13 +146,15 @@ def workspace_from_num(num):
 
 
 def workspace_rename(work, newname):
-    """ Rename a workspace """
+    """ Rename a workspace. Returns whether renaming was successful """
     invocation = ["i3-msg", "rename", "workspace", '"'+work["name"]+'"',
                   "to", '"'+newname+'"']
-    out = subprocess.check_output(invocation)
-    js = json.loads(out.decode('utf-8'))
-    if not js[0]['success']:
-        SystemExit("Renaming was not successful")
+    out = subprocess.run(invocation, stdout=subprocess.PIPE).stdout
+    try:
+        js = json.loads(out.decode('utf-8'))
+        return js[0]['success']
+    except (ValueError, IndexError, KeyError, TypeError):
+        return False
 
 
 def workspace_get_symbols(work):
@@ -72,8 +163,8 @@ def workspace_get_symbols(work):
             if not c.isdigit() and c != config.separator]
 
 
-def workspace_set_symbols(work, symbols):
-    """ Set a particular set of symbols to a workspace """
+def workspace_name(work, symbols):
+    """ Return the name a workspace gets for a particular set of symbols """
     name = str(work['num'])
 
     if symbols:
@@ -82,35 +173,42 @@ def workspace_set_symbols(work, symbols):
         else:
             name += config.separator
             name += "".join(symbols)
-    workspace_rename(work, name)
+    return name
 
 
-def workspace_autodetermine_symbols(work):
-    wins = build_workspace_windows_map()[work['num']]
+def workspace_set_symbols(work, symbols):
+    """ Set a particular set of symbols to a workspace """
+    if not workspace_rename(work, workspace_name(work, symbols)):
+        raise SystemExit("Renaming was not successful")
 
-    tags = set()
-    for w in wins:
-        prop = w['window_properties']
 
-        if 'window_role' in prop:
-            role = prop['window_role'].lower()
-            if role == 'browser':
-                tags.add('web')
+def window_tags(properties, rules):
+    """ Return the set of tags the rule table assigns to a window
+        with the given window properties """
+    return {tag for prop, regex, tag in rules
+            if isinstance(properties.get(prop), str)
+            and regex.search(properties[prop])}
+
 
-        if 'class' in prop:
-            clss = prop['class'].lower()
+def tags_to_symbols(tags):
+    """ Translate tags to symbols (in the order of config.tag_to_symbol) """
+    return [symbol for tag, symbol in config.tag_to_symbol.items()
+            if tag in tags]
 
-            if clss in ["firefox", "qutebrowser"]:
-                tags.add('web')
-            elif "thunderbird" in clss:
-                tags.add('mail')
-            elif "mpv" in clss:
-                tags.add('film')
+
+def workspace_autodetermine_symbols(work, rules=None):
+    if rules is None:
+        rules = compile_tag_rules(config.tag_rules)
+    wins = build_workspace_windows_map()[work['num']]
+
+    tags = set()
+    for w in wins:
+        tags |= window_tags(w['window_properties'], rules)
 
     if not tags:
         raise ValueError("Could not find any tags for this workspace.")
 
-    return [config.tag_to_symbol[t] for t in tags]
+    return tags_to_symbols(tags)
 
 
 def content_tree():
@@ -127,16 +225,304 @@ def content_tree():
     ]
 
 
+def window_leafs(tree):
+    """ Return the list of window leafs below a node of the i3 tree """
+    if tree['window']:
+        return [tree]
+    else:
+        return [w for sub in tree['nodes'] + tree.get('floating_nodes', [])
+                for w in window_leafs(sub)]
+
+
 def build_workspace_windows_map():
     """ Return the mapping from the workspace number
         to the list of window leafs on that workspace """
-    def traverse_tree(tree):
-        if tree['window']:
-            return [tree]
-        else:
-            return [w for sub in tree['nodes'] for w in traverse_tree(sub)]
-
-    return {win['num']: traverse_tree(win) for win in content_tree()}
+    return {win['num']: window_leafs(win) for win in content_tree()}
+
+
+class WindowIndex:
+    """
+    In-memory index of the workspaces and the windows placed on them,
+    which is kept up to date by feeding it the i3 window and
+    workspace events.
+
+    Workspaces and windows are keyed by their i3 container id,
+    such that renaming a workspace does not invalidate the index.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.workspaces = {}   # workspace id -> {'id', 'num', 'name'}
+        self.windows = {}      # window id -> {'workspace', 'tags'}
+        self.focused = None    # id of the focused workspace
+        self.pending = set()   # containers with an unknown workspace
+
+    def rebuild(self):
+        """ Populate the index from scratch using get_tree.
+            Returns the set of workspace ids, which changed
+            compared to the previous state of the index """
+        affected = set()
+        windows = {}
+        workspaces = {}
+        for work in content_tree():
+            workspaces[work['id']] = work
+            for win in window_leafs(work):
+                tags = window_tags(win['window_properties'], self.rules)
+                old = self.windows.get(win['id'])
+                if old is None or old['workspace'] != work['id'] \
+                   or old['tags'] != tags:
+                    affected.add(work['id'])
+                    affected.add(old['workspace'] if old else None)
+                windows[win['id']] = {'workspace': work['id'], 'tags': tags}
+
+        for wid, old in self.windows.items():
+            if wid not in windows:
+                affected.add(old['workspace'])
+
+        # Windows, which could not be found, are dropped
+        self.windows = windows
+        self.pending = set()
+        self.workspaces = {}
+        for work in workspaces.values():
+            self.add_workspace(work)
+        return affected - {None}
+
+    def add_workspace(self, work):
+        self.workspaces[work['id']] = {
+            'id': work['id'], 'num': work['num'], 'name': work['name']
+        }
+
+    def resolve_pending(self):
+        """ Determine the workspace of all containers, which have been
+            created or moved since the last call. Only these entries
+            are looked up in the tree, the rest of the index is kept.
+            Returns the set of affected workspace ids. """
+        if not self.pending:
+            return set()
+
+        def find_pending(tree, work):
+            if tree['id'] in self.pending:
+                # For a split container this yields all windows below it
+                return [(win, work) for win in window_leafs(tree)]
+            return [found
+                    for sub in tree['nodes'] + tree.get('floating_nodes', [])
+                    for found in find_pending(sub, work)]
+
+        found = [f for work in content_tree() for f in find_pending(work, work)]
+
+        affected = set()
+        for win, work in found:
+            old = self.windows.get(win['id'])
+            if old:
+                affected.add(old['workspace'])
+            affected.add(work['id'])
+            self.windows[win['id']] = {
+                'workspace': work['id'],
+                'tags': window_tags(win['window_properties'], self.rules),
+            }
+
+        # Pending windows, which could not be found, are gone
+        for wid in self.pending - {win['id'] for win, _ in found}:
+            old = self.windows.pop(wid, None)
+            if old:
+                affected.add(old['workspace'])
+
+        self.pending = set()
+        return affected - {None}
+
+    def handle_window_event(self, event):
+        """ Update the index from a window event.
+            Returns the set of affected workspace ids """
+        change = event['change']
+        con = event['container']
+        known = self.windows.get(con['id'])
+        old_workspace = known['workspace'] if known else None
+
+        if change == "close":
+            self.windows.pop(con['id'], None)
+            self.pending.discard(con['id'])
+            return {old_workspace} - {None}
+
+        if not con.get('window'):
+            # A split container: Its windows are only known from the tree
+            if change in ["new", "move"]:
+                self.pending.add(con['id'])
+            return set()
+
+        tags = window_tags(con.get('window_properties', {}), self.rules)
+        if known is None:
+            # The new window is most likely placed on the focused workspace,
+            # but assignments might put it elsewhere, so verify later.
+            self.windows[con['id']] = {'workspace': self.focused, 'tags': tags}
+            self.pending.add(con['id'])
+            return {self.focused} - {None}
+
+        affected = set()
+        if change == "move":
+            self.pending.add(con['id'])
+            affected.add(old_workspace)
+        if tags != known['tags']:
+            known['tags'] = tags
+            affected.add(old_workspace)
+        return affected - {None}
+
+    def handle_workspace_event(self, event):
+        """ Update the index from a workspace event.
+            Returns the set of affected workspace ids """
+        change = event['change']
+        current = event.get('current')
+
+        if change in ["reload", "restored"]:
+            return self.rebuild()
+        if not current:
+            return set()
+
+        if change == "empty":
+            self.workspaces.pop(current['id'], None)
+            windows = {}
+            for wid, win in self.windows.items():
+                if win['workspace'] != current['id']:
+                    windows[wid] = win
+                elif wid in self.pending:
+                    # Only guessed to be here: Keep until resolved
+                    win['workspace'] = None
+                    windows[wid] = win
+            self.windows = windows
+            if self.focused == current['id']:
+                self.focused = None
+            return set()
+
+        known = self.workspaces.get(current['id'])
+        self.add_workspace(current)
+        if change == "focus":
+            self.focused = current['id']
+        if change == "rename" and known and known['num'] != current['num']:
+            return {current['id']}
+        return set()
+
+    def symbols(self, workspace):
+        """ Return the symbols the rules assign to a workspace """
+        tags = set()
+        for win in self.windows.values():
+            if win['workspace'] == workspace:
+                tags |= win['tags']
+        return tags_to_symbols(tags)
+
+
+def merge_rule_symbols(work, symbols, rules):
+    """
+    Return the symbols of a workspace after replacing the symbols
+    managed by the rules with the passed symbols. Symbols which
+    cannot be assigned by any rule (e.g. manually added tags)
+    are kept.
+    """
+    managed = tags_to_symbols({tag for _, _, tag in rules})
+    current = workspace_get_symbols(work)
+    return [s for s in current if s not in managed or s in symbols] \
+        + [s for s in symbols if s not in current]
+
+
+def i3_subscribe(events):
+    """ Start an i3-msg process, which prints the requested events
+        as one json object per line """
+    invocation = ["i3-msg", "-t", "subscribe", "-m", json.dumps(events)]
+    return subprocess.Popen(invocation, stdout=subprocess.PIPE)
+
+
+def read_json_lines(fd, buf):
+    """ Read the available data from fd and parse the complete lines
+        as json. Returns the parsed objects and the unparsed rest """
+    chunk = os.read(fd, 65536)
+    if not chunk:
+        raise SystemExit("Lost connection to i3.")
+    *lines, buf = (buf + chunk).split(b"\n")
+    return [json.loads(line.decode('utf-8'))
+            for line in lines if line.strip()], buf
+
+
+def run_daemon(rules):
+    """
+    Keep the tags of all workspaces up to date by listening to
+    i3 window and workspace events.
+
+    Events are accumulated until no further relevant event arrived
+    for config.debounce seconds, such that a burst of events
+    causes only a single rename per affected workspace. Renames are
+    never delayed by more than config.max_latency seconds, however.
+
+    Only tags assigned by the rules are managed by the daemon,
+    other tags of a workspace are kept.
+    """
+    if config.compressed:
+        raise SystemExit("Daemon mode does not support compressed "
+                         "workspace names.")
+
+    # Subscribe before taking the snapshot of the tree,
+    # such that no event in between is lost.
+    proc = i3_subscribe(["window", "workspace"])
+    fd = proc.stdout.fileno()
+    buf = b""
+    events = []
+    while not events:
+        events, buf = read_json_lines(fd, buf)
+    if not events.pop(0).get('success', False):
+        raise SystemExit("Subscribing to i3 events failed.")
+
+    index = WindowIndex(rules)
+    dirty = index.rebuild()
+    focused_num = workspace_focused()['num']
+    index.focused = next((w['id'] for w in index.workspaces.values()
+                          if w['num'] == focused_num), None)
+
+    # Tag all existing workspaces right away
+    first_change = time.monotonic()   # Time of the oldest unflushed change
+    deadline = first_change
+
+    while True:
+        changed = False
+        for event in events:
+            n_pending = len(index.pending)
+            if 'container' in event:
+                affected = index.handle_window_event(event)
+            elif 'change' in event:
+                affected = index.handle_workspace_event(event)
+            else:
+                continue
+            if affected or len(index.pending) > n_pending:
+                dirty |= affected
+                changed = True
+
+        if changed:
+            now = time.monotonic()
+            if first_change is None:
+                first_change = now
+            deadline = min(now + config.debounce,
+                           first_change + config.max_latency)
+
+        timeout = None
+        if first_change is not None:
+            timeout = max(0, deadline - time.monotonic())
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if readable:
+            events, buf = read_json_lines(fd, buf)
+            continue
+        events = []
+
+        dirty |= index.resolve_pending()
+        for wid in dirty:
+            work = index.workspaces.get(wid)
+            if work is None or work['num'] < 0:
+                continue  # Workspace gone or scratchpad
+            symbols = merge_rule_symbols(work, index.symbols(wid), rules)
+            if workspace_name(work, symbols) == work['name']:
+                continue
+            # The index is updated by the following rename event
+            try:
+                workspace_set_symbols(work, symbols)
+            except SystemExit as e:
+                print("Workspace '" + work['name'] + "': " + str(e),
+                      file=sys.stderr)
+        dirty = set()
+        first_change = None
 
 
 def main():
@@ -159,9 +545,15 @@ def main():
                        help='Set a single tag to a workspace')
     group.add_argument("--list-tags", action="store_true",
                        default=False, help="List workspace tags and exit")
+    group.add_argument("--daemon", action="store_true", default=False,
+                       help="Keep running and automatically update the tags "
+                       "of all workspaces whenever windows change")
 
     # Parse args
     args = parser.parse_args()
+    if args.daemon and args.num is not None:
+        parser.error("argument --num: not allowed with argument --daemon")
+    load_config(config.configfile)
 
     if args.list_tags:
         print("The following tags are known")
@@ -169,6 +561,10 @@ def main():
             print("    {:15s} ( {:2s} )".format(tag, symbol))
         return
 
+    if args.daemon:
+        run_daemon(compile_tag_rules(config.tag_rules))
+        return
+
     # Determine info of workspace act upon
     if (args.num):
         work = workspace_from_num(args.num)